@@ -2,7 +2,7 @@
 """Ingest Generic Database tables using multi-value insert statements and multiprocessing.
 
 Usage:
-  %s <configFile> <inputFile>... [--fileoffiles] [--table=<table>] [--tableDelimiter=<tableDelimiter>] [--bundlesize=<bundlesize>] [--nprocesses=<nprocesses>] [--nfileprocesses=<nfileprocesses>] [--loglocationInsert=<loglocationInsert>] [--logprefixInsert=<logprefixInsert>] [--loglocationIngest=<loglocationIngest>] [--logprefixIngest=<logprefixIngest>] [--columns=<columns>] [--types=<types>] [--skiphtm] [--nullValue=<nullValue>] [--fktable=<fktable>] [--fktablecols=<fktablecols>] [--fktablecoltypes=<fktablecoltypes>] [--fkfield=<fkfield>] [--fkfrominputdata=<fkfrominputdata>] [--racol=<racol>] [--deccol=<deccol>]
+  %s <configFile> <inputFile>... [--fileoffiles] [--table=<table>] [--tableDelimiter=<tableDelimiter>] [--bundlesize=<bundlesize>] [--nprocesses=<nprocesses>] [--nfileprocesses=<nfileprocesses>] [--loglocationInsert=<loglocationInsert>] [--logprefixInsert=<logprefixInsert>] [--loglocationIngest=<loglocationIngest>] [--logprefixIngest=<logprefixIngest>] [--columns=<columns>] [--types=<types>] [--skiphtm] [--nullValue=<nullValue>] [--fktable=<fktable>] [--fktablecols=<fktablecols>] [--fktablecoltypes=<fktablecoltypes>] [--fkfield=<fkfield>] [--fkfrominputdata=<fkfrominputdata>] [--racol=<racol>] [--deccol=<deccol>] [--stagingcache=<stagingcache>] [--stagingcachesize=<stagingcachesize>] [--ledger=<ledger>] [--ledgertable=<ledgertable>] [--leasetime=<leasetime>]
   %s (-h | --help)
   %s --version
 
@@ -13,7 +13,7 @@ Options:
   --table=<table>                          Target table name.
   --tableDelimiter=<tableDelimiter>        Table delimiter (e.g. \\t \\s ,) where \\t = tab and \\s = space. Space delimited assumes one or more spaces between fields [default: \\s]
   --bundlesize=<bundlesize>                Group inserts into bundles of specified size [default: 1]
-  --nprocesses=<nprocesses>                Number of processes to use per ingest file. Warning: nprocesses x nfileprocesses should not exceed nCPU. [default: 1]
+  --nprocesses=<nprocesses>                Number of processes to use per ingest file. Uncompressed text files are split into byte ranges, each read by its own process. Warning: nprocesses x nfileprocesses should not exceed nCPU. [default: 1]
   --nfileprocesses=<nfileprocesses>        Number of processes over which to split the files. Warning: nprocesses x nfileprocesses should not exceed nCPU. [default: 1]
   --loglocationInsert=<loglocationInsert>  Log file location [default: /tmp/]
   --logprefixInsert=<logprefixInsert>      Log prefix [default: inserter]
@@ -30,6 +30,11 @@ Options:
   --fkfrominputdata=<fkfrominputdata>      Foreign key from input data. If set to filename it will use the datafile filename as the key [default: filename]
   --racol=<racol>                          Column that represents the RA [default: ra]
   --deccol=<deccol>                        Column that represents the Declination [default: dec]
+  --stagingcache=<stagingcache>            Directory in which to cache the parsed, enriched and typed input files. Re-ingesting an unchanged file with the same options reads the cache instead.
+  --stagingcachesize=<stagingcachesize>    Maximum size of the staging cache in MB. Least recently used files are evicted first [default: 10240]
+  --ledger=<ledger>                        Coordinate the ingest across several hosts. Workers claim files from a shared ledger - an SQLite file on a shared filesystem, or "cassandra" to use a table in the target keyspace.
+  --ledgertable=<ledgertable>              Ledger table name [default: ingest_ledger]
+  --leasetime=<leasetime>                  Seconds before a claimed file can be reclaimed from a host that has stopped renewing its lease [default: 3600]
 
 Example:
   %s config_cassandra.yaml 01a58464o0535o.dph --fktable=/Users/kws/atlas/dophot/all_co_exposures.tst --fkfield=expname --fktablecols=mjd,expname,exptime,filter,mag5sig --types=float,float,float,int,int,float,float,float,float,float,float,float,float,float,float,float,float,float --fktablecoltypes=float,str,float,str,float --table=atlasdophot --racol=RA --deccol=Dec
@@ -37,22 +42,30 @@ Example:
   %s /home/kws/config_cassandra_atlas.yaml /home/kws/atlas/dophot/ingest/parallel_machine_ingest_test/remaining_batch/exposures_around_galactic_centre_10degrees_20210219_cleaned_hko_only_second_attempt_db1 --fileoffiles --fktable=/home/kws/atlas/dophot/all_co_exposures.tst --fkfield=expname --fktablecols=mjd,expname,exptime,filter,mag5sig --types=float,float,float,int,int,float,float,float,float,float,float,float,float,float,float,float,float,float --fktablecoltypes=float,str,float,str,float --table=atlas_detections --racol=RA --deccol=Dec --nprocesses=8 --nfileprocesses=4 --loglocationIngest=/home/kws/cassandra_ingest_logs/db1/cassandra_ingest/galactic_centre_hko/ --loglocationInsert=/home/kws/cassandra_ingest_logs/db1/cassandra_ingest/galactic_centre_hko/
 
   %s /Users/kws/config_cassandra.yaml /Users/kws/lasair/cassandra/load-old-data/noncandidates/file_of_files_to_ingest.txt --fileoffiles --types=str,float,float,int,int,float,float,float,int --table=test_noncandidates --tableDelimiter=, --nprocesses=11 --nfileprocesses=1 --skiphtm
+
+  %s /home/kws/config_cassandra_atlas.yaml /home/kws/atlas/dophot/ingest/exposures_around_galactic_centre_10degrees_20210219_cleaned --fileoffiles --fktable=/home/kws/atlas/dophot/all_co_exposures.tst --fkfield=expname --fktablecols=mjd,expname,exptime,filter,mag5sig --types=float,float,float,int,int,float,float,float,float,float,float,float,float,float,float,float,float,float --fktablecoltypes=float,str,float,str,float --table=atlas_detections --racol=RA --deccol=Dec --nprocesses=8 --nfileprocesses=4 --ledger=/home/kws/atlas/dophot/ingest/galactic_centre_ledger.sqlite
 """
 import sys
-__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
+__doc__ = __doc__ % (sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0], sys.argv[0])
 from docopt import docopt
 import os, shutil, re
 from gkutils.commonutils import Struct, cleanOptions, readGenericDataFile, dbConnect, which, splitList, parallelProcess
 from datetime import datetime
 from datetime import timedelta
 import subprocess
+import time
+import multiprocessing
 from cassandra.cluster import Cluster
 import gzip
+import mmap
+import csv
 from collections import OrderedDict
 
 # 2021-02-11 KWS Import the new htmNameBulk function! No need anymore to rely on an external binary!
 #                No need to write temporary files anymore.
 from gkhtm._gkhtm import htmNameBulk, htmIDBulk
+from gkdbutils.ingesters.cassandra.ledger import SQLiteLedger, CassandraLedger, createCassandraLedgerTables, LeaseRenewer, ledgerOwner, DONE, FAILED
+from gkdbutils.ingesters.cassandra.stagingcache import stagingCacheKey, stagingCachePath, writeStagingFile, readStagingFile, stagingFileRowCount, touchStagingFile, evictStagingCache, stagingInUsePath
 
 def readZTFAvroPacket(filename, addhtm16 = None):
     from fastavro import reader
@@ -135,6 +148,29 @@ def boolToInteger(value):
         returnValue = 0
     return returnValue
 
+def castValue(value, valueType):
+    """Cast a value read from a text file to its python type (e.g. 'float', 'int', 'str')."""
+    value = nullValueNULL(boolToInteger(value))
+    if value is not None:
+        value = eval(valueType)(value)
+    return value
+
+def castData(data, types = None):
+    """Cast all the rows up front, in the same way as executeLoad does.  The types are in the same
+       order as the keys of the first row.  If there are no types, the data is already typed."""
+    if types is None or len(data) == 0:
+        return data
+
+    keys = list(data[0].keys())
+    if len(keys) != len(types):
+        raise ValueError("Keys & Types mismatch")
+
+    typedData = []
+    for row in data:
+        typedData.append(OrderedDict((key, castValue(row[key], valueType)) for key, valueType in zip(keys, types)))
+
+    return typedData
+
 
 # Use INSERT statements so we can use multiprocessing
 # 2021-10-16 KWS Why do we need types?? This is because if we send the data as a CSV dict,
@@ -194,10 +230,7 @@ def executeLoad(session, table, data, bundlesize = 1, types = None):
                 # the types are already correct. (E.g. data read from an Avro file.)
                 for key in keys:
                     if types is not None:
-                        value = nullValueNULL(boolToInteger(row[key]))
-                        if value is not None:
-                            value = eval(typesDict[key])(value)
-                        values.append(value)
+                        values.append(castValue(row[key], typesDict[key]))
                     # The data is already in the right python type. (Actually it doesn't matter! All the values are strings!)
                     else:
                         value = row[key]
@@ -206,6 +239,7 @@ def executeLoad(session, table, data, bundlesize = 1, types = None):
 
             #print(sql, tuple(values))
             session.execute(sql, tuple(values))
+            rowsUpdated += len(dataChunk)
 
 
         except Exception as e:
@@ -213,20 +247,11 @@ def executeLoad(session, table, data, bundlesize = 1, types = None):
             message = template.format(type(e).__name__, e.args)
             print(message)
 
-    return
+    return rowsUpdated
 
 
-def workerInsert(num, db, objectListFragment, dateAndTime, firstPass, miscParameters):
-    """thread worker function"""
-    # Redefine the output to be a log file.
-    options = miscParameters[0]
-
-    pid = os.getpid()
-    sys.stdout = open('%s%s_%s_%d_%d.log' % (options.loglocationInsert, options.logprefixInsert, dateAndTime, pid, num), "w")
-    cluster = Cluster(db['hostname'])
-    session = cluster.connect()
-    session.set_keyspace(db['keyspace']) 
-
+def getTypes(options):
+    """Build the list of python types for the fully enriched rows (input columns + FK columns + HTMs)."""
     combinedTypes = options.types
     if options.fktablecoltypes is not None and options.types is not None:
         combinedTypes = options.types + ',' + options.fktablecoltypes
@@ -240,17 +265,367 @@ def workerInsert(num, db, objectListFragment, dateAndTime, firstPass, miscParame
     if combinedTypes is not None:
         types = combinedTypes.split(',')
 
-    # This is in the worker function
-    objectsForUpdate = executeLoad(session, options.table, objectListFragment, int(options.bundlesize), types=types)
+    return types
 
+
+def openInsertSession(num, db, options, dateAndTime):
+    """Redirect the insert worker's output to a log file and connect to the keyspace."""
+    pid = os.getpid()
+    sys.stdout = open('%s%s_%s_%d_%d.log' % (options.loglocationInsert, options.logprefixInsert, dateAndTime, pid, num), "w")
+    cluster = Cluster(db['hostname'])
+    session = cluster.connect()
+    session.set_keyspace(db['keyspace']) 
+
+    return cluster, session
+
+
+def closeInsertSession(cluster):
     print("Process complete.")
     cluster.shutdown()
     print("Connection Closed - exiting")
 
-    return 0
 
-def ingestData(options, inputFiles, fkDict = None):
+def workerInsert(num, db, objectListFragment, dateAndTime, firstPass, miscParameters):
+    """thread worker function"""
+    # Redefine the output to be a log file.
+    options = miscParameters[0]
+
+    cluster, session = openInsertSession(num, db, options, dateAndTime)
+
+    # If the data has already been cast (e.g. it came from the staging cache) don't cast it again.
+    types = getTypes(options)
+    if len(miscParameters) > 1 and miscParameters[1]:
+        types = None
+
+    # This is in the worker function
+    objectsForUpdate = executeLoad(session, options.table, objectListFragment, int(options.bundlesize), types=types)
+
+    closeInsertSession(cluster)
+
+    # Non zero exit status tells the parent that some rows didn't go in.
+    return 0 if objectsForUpdate == len(objectListFragment) else 1
+
+
+def workerInsertByteRange(num, db, byteRanges, dateAndTime, firstPass, miscParameters):
+    """thread worker function - reads, enriches and inserts its own byte range(s) of a file"""
+    # Redefine the output to be a log file.
+    options = miscParameters[0]
+    fkDict = miscParameters[1]
+
+    cluster, session = openInsertSession(num, db, options, dateAndTime)
+
+    types = getTypes(options)
+
+    status = 0
+    for inputFile, byteStart, byteEnd in byteRanges:
+        print("Ingesting %s bytes %d to %d" % (inputFile, byteStart, byteEnd))
+        try:
+            data = readGenericDataFileRange(inputFile, byteStart, byteEnd, delimiter=getDelimiter(options))
+            data = enrichData(options, data, inputFile, fkDict = fkDict)
+        except Exception as e:
+            print("Unable to read %s bytes %d to %d: %s" % (inputFile, byteStart, byteEnd, e))
+            status = 1
+            continue
+        objectsForUpdate = executeLoad(session, options.table, data, int(options.bundlesize), types=types)
+        if objectsForUpdate != len(data):
+            status = 1
+
+    closeInsertSession(cluster)
 
+    return status
+
+
+def workerInsertFromCache(num, db, rowRanges, dateAndTime, firstPass, miscParameters):
+    """thread worker function - reads and inserts its own row range(s) of a staging cache file"""
+    # Redefine the output to be a log file.
+    options = miscParameters[0]
+
+    cluster, session = openInsertSession(num, db, options, dateAndTime)
+
+    status = 0
+    for cacheFile, rowStart, rowEnd in rowRanges:
+        print("Ingesting %s rows %d to %d" % (cacheFile, rowStart, rowEnd))
+        try:
+            data = readStagingFile(cacheFile, rowStart, rowEnd)
+        except (OSError, ValueError) as e:
+            print("Unable to read %s rows %d to %d: %s" % (cacheFile, rowStart, rowEnd, e))
+            status = 1
+            continue
+        # The cached data is already typed.
+        objectsForUpdate = executeLoad(session, options.table, data, int(options.bundlesize), types=None)
+        if objectsForUpdate != len(data):
+            status = 1
+
+    closeInsertSession(cluster)
+
+    return status
+
+
+def runInsertWorker(worker, num, db, listChunk, dateAndTime, miscParameters):
+    # The worker's return value becomes the process exit status.
+    sys.exit(worker(num, db, listChunk, dateAndTime, True, miscParameters))
+
+
+def parallelInsert(db, dateAndTime, listChunks, worker, miscParameters):
+    """Like parallelProcess, but wait for the insert processes and return True only if they all
+       succeeded (exit status 0). A worker that crashes also counts as a failure."""
+    print("%s Parallel Processing..." % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
+    processes = []
+    for i in range(len(listChunks)):
+        p = multiprocessing.Process(target=runInsertWorker, args=(worker, i, db, listChunks[i], dateAndTime, miscParameters))
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+    print("%s Done Parallel Processing" % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
+
+    failed = [p for p in processes if p.exitcode != 0]
+    if failed:
+        print("%d of %d insert processes failed" % (len(failed), len(processes)))
+
+    return len(failed) == 0
+
+
+def getStagingCacheFile(options, inputFile):
+    """Return the staging cache filename for this input file and these ingest options (or None if
+       we are not caching). Any option that changes the parsed data must be part of the key."""
+    if not options.stagingcache:
+        return None
+
+    fktableMtime = None
+    if options.fktable:
+        fktableMtime = os.stat(options.fktable).st_mtime_ns
+
+    keyItems = [options.tableDelimiter, options.columns, options.types,
+                options.fktable, fktableMtime, options.fktablecols, options.fktablecoltypes, options.fkfield, options.fkfrominputdata,
+                options.skiphtm, options.racol, options.deccol]
+
+    # The table name only changes the rows for Avro packets (candidates or noncandidates).
+    # Otherwise we want to be able to reuse the cache to ingest into a different table.
+    if 'avro' in inputFile:
+        keyItems.append(options.table)
+
+    return stagingCachePath(options.stagingcache, stagingCacheKey(inputFile, keyItems))
+
+
+def splitRowRanges(cacheFile, nranges):
+    """Split the rows of a staging cache file into at most nranges (filename, start, end) ranges."""
+    nrows = stagingFileRowCount(cacheFile)
+    nranges = max(1, min(nranges, nrows))
+    rowRanges = []
+    for i in range(nranges):
+        rowStart = int(i * nrows / nranges)
+        rowEnd = int((i + 1) * nrows / nranges)
+        if rowEnd > rowStart:
+            rowRanges.append((cacheFile, rowStart, rowEnd))
+    return rowRanges
+
+
+def insertFromStagingCache(options, db, dateAndTime, cacheFile, nprocesses):
+    """Insert the rows of a staging cache file in parallel. Returns None if the file is not in
+       the cache (or can't be read), in which case the input file should be parsed instead.
+       Otherwise returns True if all the rows were inserted."""
+    # Other processes sharing the cache directory can evict the file at any moment, so take a
+    # private hard link to it (which eviction ignores) while we are inserting from it.
+    privateCacheFile = stagingInUsePath(cacheFile)
+    try:
+        os.link(cacheFile, privateCacheFile)
+    except OSError:
+        return None
+
+    try:
+        try:
+            # Same inode, so this marks the cache file as recently used.
+            touchStagingFile(privateCacheFile)
+            rowRanges = splitRowRanges(privateCacheFile, nprocesses)
+        except (OSError, ValueError) as e:
+            print("Unable to read staging cache file %s: %s" % (cacheFile, e))
+            return None
+
+        print("Using staging cache file %s" % cacheFile)
+        success = True
+        if len(rowRanges) > 0:
+            listChunks = [[rowRange] for rowRange in rowRanges]
+            success = parallelInsert(db, dateAndTime, listChunks, workerInsertFromCache, [options])
+    finally:
+        os.remove(privateCacheFile)
+
+    return success
+
+
+def getDelimiter(options):
+    delimiter=options.tableDelimiter
+    if delimiter == '\\s':
+        delimiter = ' '
+    if delimiter == '\\t':
+        delimiter = '\t'
+    return delimiter
+
+
+def readHeader(inputFile, delimiter = ' '):
+    """Read the column names from the first line of an uncompressed text file. Return the names
+       and the byte offset of the first data line."""
+    with open(inputFile, 'rb') as f:
+        header = f.readline()
+        dataStart = f.tell()
+
+    # Parse the header the same way as readGenericDataFile - drop any leading '#' and split
+    # space delimited headers on any amount of whitespace.
+    header = header.decode().strip()
+    if header.startswith('#'):
+        header = header[1:]
+
+    if delimiter == ' ':
+        fieldnames = header.split()
+    else:
+        reader = csv.reader([header], delimiter=delimiter)
+        fieldnames = [name.strip() for name in next(reader)]
+
+    return fieldnames, dataStart
+
+
+def splitFileByteRanges(inputFile, nranges):
+    """Split the data section of an uncompressed text file into nranges (filename, start, end)
+       byte ranges. The ranges are NOT aligned to line boundaries - the reader does that."""
+    fieldnames, dataStart = readHeader(inputFile)
+    fileSize = os.path.getsize(inputFile)
+
+    if fileSize <= dataStart:
+        return []
+
+    rangeSize = max(1, int((fileSize - dataStart) / nranges))
+
+    byteRanges = []
+    byteStart = dataStart
+    while byteStart < fileSize and len(byteRanges) < nranges:
+        byteEnd = byteStart + rangeSize
+        if len(byteRanges) == nranges - 1:
+            byteEnd = fileSize
+        byteEnd = min(byteEnd, fileSize)
+        byteRanges.append((inputFile, byteStart, byteEnd))
+        byteStart = byteEnd
+
+    return byteRanges
+
+
+def readGenericDataFileRange(inputFile, byteStart, byteEnd, delimiter = ' '):
+    """Read the rows of an uncompressed text file whose first byte lies in [byteStart, byteEnd).
+       The file is memory mapped, so only the requested slice is read. The column names come from
+       the first line of the file. Returns a list of OrderedDicts, like readGenericDataFile."""
+    fieldnames, dataStart = readHeader(inputFile, delimiter = delimiter)
+
+    data = []
+    with open(inputFile, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= dataStart:
+            return data
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # A line belongs to the range that contains its first byte. So move the start
+            # forward to the beginning of the next line (unless we are already at a line start)
+            # and move the end forward to the end of the line it falls in.
+            byteStart = max(byteStart, dataStart)
+            if byteStart > dataStart:
+                newline = mm.find(b'\n', byteStart - 1)
+                byteStart = len(mm) if newline == -1 else newline + 1
+
+            if byteEnd < len(mm):
+                newline = mm.find(b'\n', byteEnd - 1)
+                byteEnd = len(mm) if newline == -1 else newline + 1
+            else:
+                byteEnd = len(mm)
+
+            if byteStart >= byteEnd:
+                return data
+
+            lines = mm[byteStart:byteEnd].decode().splitlines()
+        finally:
+            mm.close()
+
+    reader = csv.DictReader(lines, fieldnames=fieldnames, delimiter=delimiter, skipinitialspace = (delimiter == ' '))
+    for row in reader:
+        # Ignore blank lines
+        if not any(row.values()):
+            continue
+        # Surplus fields (key None) are dropped, as are missing ones (value None)
+        data.append(OrderedDict((k, v.strip() if v is not None else v) for k, v in row.items() if k is not None))
+
+    return data
+
+
+def enrichData(options, data, inputFile, fkDict = None):
+    """Trim the columns, join the foreign key table data and add the HTMs."""
+    # 2021-07-29 KWS This is a bit inefficient, but trim the data down to specified columns if they are present.
+    if options.columns:
+        trimmedData = []
+        for row in data:
+            trimmedRow = {key: row[key] for key in options.columns.split(',')}
+            trimmedData.append(trimmedRow)
+        data = trimmedData
+
+
+    foreignKey = options.fkfrominputdata
+    if foreignKey == 'filename':
+        foreignKey = os.path.basename(inputFile).split('.')[0]
+
+
+    if fkDict:
+        for i in range(len(data)):
+            try:
+                if options.fktablecols:
+                    # just pick out the specified keys
+                    keys = options.fktablecols.split(',')
+                    for k in keys:
+                        data[i][k] = fkDict[foreignKey][k]
+                else:
+                    # Use all the keys by default
+                    for k,v in fkDict[foreignKey].items():
+                        data[i][k] = v
+            except KeyError as e:
+                pass
+
+    #print(data[0])
+
+    if not options.skiphtm:
+
+        coords = []
+        for row in data:
+            coords.append([float(row[options.racol]), float(row[options.deccol])])
+
+        htm16Names = htmNameBulk(16, coords)
+
+        # For Cassandra, we're going to split the HTM Name across several columns.
+        # Furthermore, we only need to do this once for the deepest HTM level, because
+        # This is always a subset of the higher levels.  Hence we only need to store
+        # the tail end of the HTM name in the actual HTM 16 column.  So...  we store
+        # the full HTM10 name as the first 12 characters of the HTM 16 one, then the
+        # next 3 characters into the HTM 13 column, then the next 3 characters (i.e.
+        # the last few characters) the HTM 16 column
+        # e.g.:
+        # ra, dec =      288.70392, 9.99498
+        # HTM 10  = N02323033011
+        # HTM 13  = N02323033011 211
+        # HTM 16  = N02323033011 211 311
+
+        # Incidentally, this hierarchy also works in binary and we should seriously
+        # reconsider how we are currently using HTMs.
+
+        # HTM10 ID =    13349829 = 11 00 10 11 10 11 00 11 11 00 01 01
+        # HTM13 ID =   854389093 = 11 00 10 11 10 11 00 11 11 00 01 01  10 01 01
+        # HTM16 ID = 54680902005 = 11 00 10 11 10 11 00 11 11 00 01 01  10 01 01  11 01 01
+
+
+        for i in range(len(data)):
+            # Add the HTM IDs to the data
+            data[i]['htm10'] = htm16Names[i][0:12]
+            data[i]['htm13'] = htm16Names[i][12:15]
+            data[i]['htm16'] = htm16Names[i][15:18]
+
+    return data
+
+
+def readCassandraConfig(options):
     import yaml
     with open(options.configFile) as yaml_file:
         config = yaml.safe_load(yaml_file)
@@ -265,18 +640,49 @@ def ingestData(options, inputFiles, fkDict = None):
           'keyspace': keyspace,
           'hostname': hostname}
 
+    return db
+
+
+def ingestData(options, inputFiles, fkDict = None):
+
+    db = readCassandraConfig(options)
+
     currentDate = datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
     (year, month, day, hour, min, sec) = currentDate.split(':')
     dateAndTime = "%s%s%s_%s%s%s" % (year, month, day, hour, min, sec)
 
-    delimiter=options.tableDelimiter
-    if delimiter == '\\s':
-        delimiter = ' '
-    if delimiter == '\\t':
-        delimiter = '\t'
+    delimiter = getDelimiter(options)
+    nprocesses = int(options.nprocesses)
+
+    if options.stagingcache:
+        os.makedirs(options.stagingcache, exist_ok=True)
+
+    # Becomes False if any rows of any of the files failed to go in.
+    success = True
 
     for inputFile in inputFiles:
         print("Ingesting %s" % inputFile)
+
+        # If we've seen this file before (with the same options) skip straight to the insert.
+        cacheFile = getStagingCacheFile(options, inputFile)
+        if cacheFile is not None:
+            cacheSuccess = insertFromStagingCache(options, db, dateAndTime, cacheFile, nprocesses)
+            if cacheSuccess is not None:
+                success = success and cacheSuccess
+                continue
+
+        # If we have a single uncompressed text file and several processes, don't read
+        # and enrich the whole file here and then ship the rows to the children. Just send each
+        # child a byte range of the file. Each child reads (via mmap), enriches and inserts its
+        # own slice, so the parent is no longer the bottleneck. If we are writing a staging
+        # cache, we need the whole file here, so don't split.
+        if nprocesses > 1 and cacheFile is None and '.gz' not in inputFile and 'avro' not in inputFile:
+            byteRanges = splitFileByteRanges(inputFile, nprocesses)
+            if len(byteRanges) > 0:
+                listChunks = [[byteRange] for byteRange in byteRanges]
+                success = parallelInsert(db, dateAndTime, listChunks, workerInsertByteRange, [options, fkDict]) and success
+            continue
+
         if '.gz' in inputFile:
             # It's probably gzipped
             f = gzip.open(inputFile, 'rb')
@@ -300,82 +706,25 @@ def ingestData(options, inputFiles, fkDict = None):
             # column types.
             data = readGenericDataFile(f, delimiter=delimiter, useOrderedDict=True)
 
-        # 2021-07-29 KWS This is a bit inefficient, but trim the data down to specified columns if they are present.
-        if options.columns:
-            trimmedData = []
-            for row in data:
-                trimmedRow = {key: row[key] for key in options.columns.split(',')}
-                trimmedData.append(trimmedRow)
-            data = trimmedData
-
+        data = enrichData(options, data, inputFile, fkDict = fkDict)
 
-        foreignKey = options.fkfrominputdata
-        if foreignKey == 'filename':
-            foreignKey = os.path.basename(inputFile).split('.')[0]
-
-
-        if fkDict:
-            for i in range(len(data)):
-                try:
-                    if options.fktablecols:
-                        # just pick out the specified keys
-                        keys = options.fktablecols.split(',')
-                        for k in keys:
-                            data[i][k] = fkDict[foreignKey][k]
-                    else:
-                        # Use all the keys by default
-                        for k,v in fkDict[foreignKey].items():
-                            data[i][k] = v
-                except KeyError as e:
-                    pass
+        preTyped = False
+        if cacheFile is not None:
+            try:
+                typedData = castData(data, getTypes(options))
+                writeStagingFile(cacheFile, typedData)
+                evictStagingCache(options.stagingcache, int(options.stagingcachesize) * 1024 * 1024)
+                data = typedData
+                preTyped = True
+            except Exception as e:
+                # Don't stop the ingest just because we can't cache the file.
+                print("Unable to write staging cache file %s: %s" % (cacheFile, e))
 
-        #print(data[0])
-        pid = os.getpid()
-    
-        if not options.skiphtm:
-    
-            coords = []
-            for row in data:
-                coords.append([float(row[options.racol]), float(row[options.deccol])])
-    
-            htm16Names = htmNameBulk(16, coords)
-
-            # For Cassandra, we're going to split the HTM Name across several columns.
-            # Furthermore, we only need to do this once for the deepest HTM level, because
-            # This is always a subset of the higher levels.  Hence we only need to store
-            # the tail end of the HTM name in the actual HTM 16 column.  So...  we store
-            # the full HTM10 name as the first 12 characters of the HTM 16 one, then the
-            # next 3 characters into the HTM 13 column, then the next 3 characters (i.e.
-            # the last few characters) the HTM 16 column
-            # e.g.:
-            # ra, dec =      288.70392, 9.99498
-            # HTM 10  = N02323033011
-            # HTM 13  = N02323033011 211
-            # HTM 16  = N02323033011 211 311
-
-            # Incidentally, this hierarchy also works in binary and we should seriously
-            # reconsider how we are currently using HTMs.
-
-            # HTM10 ID =    13349829 = 11 00 10 11 10 11 00 11 11 00 01 01
-            # HTM13 ID =   854389093 = 11 00 10 11 10 11 00 11 11 00 01 01  10 01 01
-            # HTM16 ID = 54680902005 = 11 00 10 11 10 11 00 11 11 00 01 01  10 01 01  11 01 01
-
-
-            for i in range(len(data)):
-                # Add the HTM IDs to the data
-                data[i]['htm10'] = htm16Names[i][0:12]
-                data[i]['htm13'] = htm16Names[i][12:15]
-                data[i]['htm16'] = htm16Names[i][15:18]
-    
-    
-        nprocesses = int(options.nprocesses)
-    
         if len(data) > 0:
             nProcessors, listChunks = splitList(data, bins = nprocesses, preserveOrder=True)
-    
-            print("%s Parallel Processing..." % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
-            parallelProcess(db, dateAndTime, nProcessors, listChunks, workerInsert, miscParameters = [options], drainQueues = False)
-            print("%s Done Parallel Processing" % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
+            success = parallelInsert(db, dateAndTime, listChunks, workerInsert, [options, preTyped]) and success
+
+    return success
 
 
     
@@ -394,6 +743,68 @@ def workerIngest(num, db, objectListFragment, dateAndTime, firstPass, miscParame
 
     return 0
 
+def openLedger(options, createTables = False):
+    """Open the shared work ledger - either an SQLite file or a table in the target keyspace.
+       Only the parent process should ask for the Cassandra tables to be created (see
+       cql/ingest_ledger.cql), so that the workers don't all issue the same DDL at once."""
+    if options.ledger == 'cassandra':
+        db = readCassandraConfig(options)
+        cluster = Cluster(db['hostname'])
+        session = cluster.connect()
+        session.set_keyspace(db['keyspace'])
+        if createTables:
+            createCassandraLedgerTables(session, db['keyspace'], options.ledgertable)
+        return CassandraLedger(session, leaseSeconds = int(options.leasetime), table = options.ledgertable)
+
+    return SQLiteLedger(options.ledger, leaseSeconds = int(options.leasetime), table = options.ledgertable)
+
+
+def workerIngestFromLedger(num, db, objectListFragment, dateAndTime, firstPass, miscParameters):
+    """thread worker function - keep claiming files from the ledger until there are none left"""
+    # Redefine the output to be a log file.
+    options = miscParameters[0]
+    fkDict = miscParameters[1]
+    pid = os.getpid()
+    sys.stdout = open('%s%s_%s_%d_%d.log' % (options.loglocationIngest, options.logprefixIngest, dateAndTime, pid, num), "w")
+
+    ledger = openLedger(options)
+    owner = ledgerOwner()
+
+    while True:
+        inputFile = ledger.claim(owner)
+        if inputFile is None:
+            # Other hosts may still hold leases. If one of them dies we need to pick up its files,
+            # so keep checking until everything is done.
+            if ledger.pending() == 0:
+                break
+            time.sleep(min(60, int(options.leasetime) / 3.0))
+            continue
+
+        print("%s Claimed %s" % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S"), inputFile))
+        renewer = LeaseRenewer(ledger, inputFile, owner)
+        renewer.start()
+        status = FAILED
+        try:
+            # Only mark the file done if every chunk of it went in.
+            if ingestData(options, [inputFile], fkDict = fkDict):
+                status = DONE
+            else:
+                print("Failed to ingest all of %s" % inputFile)
+        except (Exception, SystemExit) as e:
+            # ingestData calls exit() on a bad Avro table definition. Don't let one bad file
+            # take down every worker that claims it.
+            print("Failed to ingest %s: %r" % (inputFile, e))
+        finally:
+            renewer.stop()
+
+        if not ledger.setStatus(inputFile, owner, status):
+            print("WARNING: %s was reclaimed by another host before we finished" % inputFile)
+
+    ledger.close()
+    print("Process complete.")
+
+    return 0
+
 def ingestDataMultiprocess(options, fkDict = None):
 
     currentDate = datetime.now().strftime("%Y:%m:%d:%H:%M:%S")
@@ -412,6 +823,20 @@ def ingestDataMultiprocess(options, fkDict = None):
             files += content
 
     print(files)
+
+    # In coordination mode, don't split the files here. Add them to the shared ledger and let
+    # every worker (on every host) claim files from it until there are none left.
+    if options.ledger:
+        ledger = openLedger(options, createTables = True)
+        ledger.addFiles(files)
+        ledger.close()
+
+        nProcessors = int(options.nfileprocesses)
+        print("%s Parallel Processing..." % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
+        parallelProcess([], dateAndTime, nProcessors, [[i] for i in range(nProcessors)], workerIngestFromLedger, miscParameters = [options, fkDict], drainQueues = False)
+        print("%s Done Parallel Processing" % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
+        return
+
     nProcessors, fileSublist = splitList(files, bins = int(options.nfileprocesses), preserveOrder=True)
     
     print("%s Parallel Processing..." % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
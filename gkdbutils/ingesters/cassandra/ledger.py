@@ -0,0 +1,193 @@
+"""Shared, lease-based work ledgers so that several hosts can ingest the same list of files.
+
+Every host adds its list of files to the ledger (files already there are left alone) and
+then its workers repeatedly claim a file, ingest it and mark it done.  A claim is a lease
+that expires after leaseSeconds.  The worker renews the lease while it is still ingesting,
+and if a host dies its files are picked up by another host once the lease runs out.
+
+Two ledgers are available - an SQLite file (which can live on a shared filesystem) and a
+table in the target Cassandra keyspace (using lightweight transactions).  Both have the
+same methods, and each file is in one of the following states:
+
+  pending  - not yet ingested (it may have an unexpired lease on it)
+  done     - ingested
+  failed   - the ingest raised an exception.  Set back to pending (and, for the Cassandra
+             ledger, add the files again) to retry.
+"""
+import os
+import time
+import random
+import socket
+import sqlite3
+import threading
+import zlib
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def ledgerOwner():
+    """A unique name for this worker - hostname and process ID."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class SQLiteLedger(object):
+    def __init__(self, filename, leaseSeconds = 3600, table = 'ingest_ledger'):
+        self.leaseSeconds = leaseSeconds
+        self.table = table
+        self.lock = threading.Lock()
+        # Autocommit mode, so we can control the transactions ourselves.
+        self.conn = sqlite3.connect(filename, timeout = 300, isolation_level = None, check_same_thread = False)
+        with self.lock:
+            self.conn.execute("create table if not exists %s (filename text primary key, status text not null, owner text, expires real not null)" % self.table)
+
+    def addFiles(self, files):
+        with self.lock:
+            self.conn.execute("begin immediate")
+            try:
+                self.conn.executemany("insert or ignore into %s (filename, status, owner, expires) values (?, ?, null, 0)" % self.table, [(f, PENDING) for f in files])
+                self.conn.execute("commit")
+            except Exception:
+                self.conn.execute("rollback")
+                raise
+
+    def claim(self, owner):
+        """Lease the next unclaimed (or expired) pending file.  Returns None if there is nothing left to claim."""
+        with self.lock:
+            now = time.time()
+            # begin immediate takes the write lock, so no other host can claim the same file.
+            self.conn.execute("begin immediate")
+            try:
+                row = self.conn.execute("select filename from %s where status = ? and expires < ? order by rowid limit 1" % self.table, (PENDING, now)).fetchone()
+                filename = None
+                if row is not None:
+                    filename = row[0]
+                    self.conn.execute("update %s set owner = ?, expires = ? where filename = ?" % self.table, (owner, now + self.leaseSeconds, filename))
+                self.conn.execute("commit")
+            except Exception:
+                self.conn.execute("rollback")
+                raise
+        return filename
+
+    def renew(self, filename, owner):
+        """Extend our lease.  Returns False if we no longer hold it."""
+        with self.lock:
+            cursor = self.conn.execute("update %s set expires = ? where filename = ? and owner = ? and status = ?" % self.table, (time.time() + self.leaseSeconds, filename, owner, PENDING))
+        return cursor.rowcount > 0
+
+    def setStatus(self, filename, owner, status):
+        with self.lock:
+            cursor = self.conn.execute("update %s set status = ? where filename = ? and owner = ?" % self.table, (status, filename, owner))
+        return cursor.rowcount > 0
+
+    def pending(self):
+        """Number of files still to be ingested (including currently leased ones)."""
+        with self.lock:
+            return self.conn.execute("select count(*) from %s where status = ?" % self.table, (PENDING,)).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def createCassandraLedgerTables(session, keyspace, table = 'ingest_ledger'):
+    """Create the ledger and queue tables (as in cql/ingest_ledger.cql) if they don't exist yet.
+       Call this once, before any workers start."""
+    tables = session.cluster.metadata.keyspaces[keyspace].tables
+    if table not in tables:
+        session.execute("create table if not exists %s (filename text primary key, status text, owner text, expires double)" % table)
+    if table + '_pending' not in tables:
+        session.execute("create table if not exists %s_pending (bucket int, filename text, primary key (bucket, filename))" % table)
+
+
+class CassandraLedger(object):
+    """The ledger table holds the state of every file and is updated with lightweight transactions.
+       So that a claim doesn't have to read the whole ledger, the files still to be done are also
+       listed in a queue table (<table>_pending), spread over NBUCKETS partitions.  A file leaves
+       the queue when it is done or has failed."""
+    NBUCKETS = 64
+
+    def __init__(self, session, leaseSeconds = 3600, table = 'ingest_ledger'):
+        self.session = session
+        self.leaseSeconds = leaseSeconds
+        self.table = table
+        self.queueTable = table + '_pending'
+        self.insertStatement = self.session.prepare("insert into %s (filename, status, expires) values (?, ?, 0) if not exists" % self.table)
+        self.claimStatement = self.session.prepare("update %s set owner = ?, expires = ? where filename = ? if status = ? and expires < ?" % self.table)
+        self.renewStatement = self.session.prepare("update %s set expires = ? where filename = ? if owner = ? and status = ?" % self.table)
+        self.statusStatement = self.session.prepare("update %s set status = ? where filename = ? if owner = ?" % self.table)
+        self.enqueueStatement = self.session.prepare("insert into %s (bucket, filename) values (?, ?)" % self.queueTable)
+        self.dequeueStatement = self.session.prepare("delete from %s where bucket = ? and filename = ?" % self.queueTable)
+        self.queueStatement = self.session.prepare("select filename from %s where bucket = ?" % self.queueTable)
+        self.queueStatement.fetch_size = 100
+        self.countStatement = self.session.prepare("select count(*) from %s where bucket = ?" % self.queueTable)
+
+    def bucket(self, filename):
+        return zlib.crc32(filename.encode()) % self.NBUCKETS
+
+    def addFiles(self, files):
+        for f in files:
+            result = self.session.execute(self.insertStatement, (f, PENDING))
+            # Queue new files, and pending ones (in case they were set back to pending by hand).
+            if result.was_applied or result.one().status == PENDING:
+                self.session.execute(self.enqueueStatement, (self.bucket(f), f))
+
+    def claim(self, owner):
+        """Lease an unclaimed (or expired) pending file.  Returns None if there is nothing left to claim."""
+        # Start at a random bucket, so that hosts don't all fight over the same files. Only the
+        # queued files that are currently leased by others are read before we find a free one.
+        start = random.randrange(self.NBUCKETS)
+        for i in range(self.NBUCKETS):
+            bucket = (start + i) % self.NBUCKETS
+            for row in self.session.execute(self.queueStatement, (bucket,)):
+                now = time.time()
+                result = self.session.execute(self.claimStatement, (owner, now + self.leaseSeconds, row.filename, PENDING, now))
+                if result.was_applied:
+                    return row.filename
+                if result.one().status != PENDING:
+                    # Done or failed, but we didn't get as far as removing it from the queue.
+                    self.session.execute(self.dequeueStatement, (bucket, row.filename))
+        return None
+
+    def renew(self, filename, owner):
+        """Extend our lease.  Returns False if we no longer hold it."""
+        return self.session.execute(self.renewStatement, (time.time() + self.leaseSeconds, filename, owner, PENDING)).was_applied
+
+    def setStatus(self, filename, owner, status):
+        applied = self.session.execute(self.statusStatement, (status, filename, owner)).was_applied
+        if applied and status != PENDING:
+            self.session.execute(self.dequeueStatement, (self.bucket(filename), filename))
+        return applied
+
+    def pending(self):
+        """Number of files still to be ingested (including currently leased ones)."""
+        return sum([self.session.execute(self.countStatement, (bucket,)).one()[0] for bucket in range(self.NBUCKETS)])
+
+    def close(self):
+        # The ledger owns its session.
+        self.session.cluster.shutdown()
+
+
+class LeaseRenewer(threading.Thread):
+    """Background thread that keeps renewing a lease until stopped."""
+    def __init__(self, ledger, filename, owner):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ledger = ledger
+        self.filename = filename
+        self.owner = owner
+        self.stopped = threading.Event()
+
+    def run(self):
+        # Renew well before the lease runs out.
+        while not self.stopped.wait(self.ledger.leaseSeconds / 3.0):
+            try:
+                if not self.ledger.renew(self.filename, self.owner):
+                    print("WARNING: Lost the lease on %s" % self.filename)
+                    return
+            except Exception as e:
+                print("WARNING: Unable to renew the lease on %s: %s" % (self.filename, e))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,297 @@
+"""Binary staging cache of parsed and enriched ingest data.
+
+Each cached input file is stored as one binary columnar file that can be memory
+mapped.  The layout is:
+
+  8 bytes   magic (GKSC0001)
+  8 bytes   header length (little endian unsigned long long)
+  n bytes   JSON header - number of rows and the column descriptions
+  ...       column blocks, each starting on an 8 byte boundary
+
+Every column has a null mask (one byte per row) followed by its values.  Float,
+int and bool columns are stored as fixed width arrays.  String columns (and ints
+too big for 64 bits) are stored as an array of n+1 offsets plus a UTF-8 blob.
+Readers can pull out any range of rows without reading the rest of the file.
+
+The cache directory is limited in size.  Files are evicted least recently used
+first, where "used" is the file modification time, which we touch on every hit.
+Readers take a private hard link (<key>.gksc.<pid>.inuse) to a cache file while
+they use it, so eviction can't remove it under them.  Links left behind by dead
+processes and temporary files left by failed writes are removed once stale.
+"""
+import os
+import json
+import mmap
+import struct
+import hashlib
+import tempfile
+import time
+from array import array
+from collections import OrderedDict
+
+MAGIC = b'GKSC0001'
+SUFFIX = '.gksc'
+INUSE_SUFFIX = '.inuse'
+TEMP_SUFFIX = '.tmp'
+
+# Leftover temporary files and in-use links older than this (seconds) are removed.
+STALE_SECONDS = 24 * 3600
+
+# Column kind -> array typecode for fixed width columns
+FIXEDWIDTH = {'float': 'd', 'int': 'q', 'bool': 'b'}
+
+
+def stagingCacheKey(inputFile, keyItems):
+    """Build the cache key from the input file path, its size and modification time and the
+       (JSON serialisable) list of ingest options that affect the parsed data."""
+    stat = os.stat(inputFile)
+    keyData = json.dumps([os.path.abspath(inputFile), stat.st_size, stat.st_mtime_ns, keyItems], sort_keys=True)
+    return hashlib.sha1(keyData.encode()).hexdigest()
+
+
+def stagingCachePath(cacheDir, key):
+    return os.path.join(cacheDir, key + SUFFIX)
+
+
+def stagingInUsePath(cacheFile):
+    """The name of this process's private link to a cache file."""
+    return '%s.%d%s' % (cacheFile, os.getpid(), INUSE_SUFFIX)
+
+
+def _columnKind(key, values):
+    """Work out the storage kind of a column from its (non-null) python values. Ints mixed with
+       floats are stored as floats.  Any other mixture, or any other type, raises ValueError so
+       that we never silently change a value."""
+    kinds = set()
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            kinds.add('bool')
+        elif isinstance(value, int):
+            kinds.add('int')
+        elif isinstance(value, float):
+            kinds.add('float')
+        elif isinstance(value, str):
+            kinds.add('str')
+        else:
+            raise ValueError("Column %s: can't cache values of type %s" % (key, type(value).__name__))
+
+    if len(kinds) == 0:
+        return 'str'
+    if kinds == set(['int', 'float']):
+        return 'float'
+    if len(kinds) > 1:
+        raise ValueError("Column %s: can't cache a mixture of types (%s)" % (key, ', '.join(sorted(kinds))))
+    return kinds.pop()
+
+
+def _pad(f):
+    padding = (-f.tell()) % 8
+    if padding:
+        f.write(b'\0' * padding)
+
+
+def writeStagingFile(filename, data):
+    """Write a list of (typed) dicts to a staging file.  All rows must have the keys of the
+       first row.  The file is written to a temporary name and renamed, so readers never see
+       a partial file."""
+    keys = list(data[0].keys()) if len(data) > 0 else []
+    nrows = len(data)
+
+    columns = []
+    for key in keys:
+        values = [row[key] for row in data]
+        kind = _columnKind(key, values)
+        nullMask = bytes(1 if v is None else 0 for v in values)
+
+        if kind in FIXEDWIDTH:
+            default = False if kind == 'bool' else 0
+            # array('d') promotes any ints in a float column to floats.
+            try:
+                blocks = [array(FIXEDWIDTH[kind], [default if v is None else v for v in values]).tobytes()]
+            except OverflowError:
+                kind = 'bigint'
+
+        if kind in ('str', 'bigint'):
+            encoded = [b'' if v is None else str(v).encode() for v in values]
+            offsets = array('q', [0])
+            for value in encoded:
+                offsets.append(offsets[-1] + len(value))
+            blocks = [offsets.tobytes(), b''.join(encoded)]
+
+        columns.append((key, kind, nullMask, blocks))
+
+    cacheDir = os.path.dirname(os.path.abspath(filename))
+    fd, tempName = tempfile.mkstemp(dir=cacheDir, suffix=TEMP_SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # Write a placeholder header first so we know where the data starts.
+            header = {'rows': nrows, 'columns': []}
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', 0))
+            dataStart = f.tell()
+
+            # Calculate the offsets relative to the start of the data section.
+            offset = 0
+            for key, kind, nullMask, blocks in columns:
+                column = {'name': key, 'kind': kind, 'nulls': offset}
+                offset += len(nullMask) + (-len(nullMask)) % 8
+                column['blocks'] = []
+                for block in blocks:
+                    column['blocks'].append([offset, len(block)])
+                    offset += len(block) + (-len(block)) % 8
+                header['columns'].append(column)
+
+            headerBytes = json.dumps(header).encode()
+            headerBytes += b' ' * ((-(dataStart + len(headerBytes))) % 8)
+            f.write(headerBytes)
+            f.seek(len(MAGIC))
+            f.write(struct.pack('<Q', len(headerBytes)))
+            f.seek(0, os.SEEK_END)
+
+            for key, kind, nullMask, blocks in columns:
+                f.write(nullMask)
+                _pad(f)
+                for block in blocks:
+                    f.write(block)
+                    _pad(f)
+
+        os.replace(tempName, filename)
+    except Exception:
+        os.remove(tempName)
+        raise
+
+
+def _readHeader(mm):
+    if mm[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a staging cache file')
+    headerLength = struct.unpack('<Q', mm[len(MAGIC):len(MAGIC) + 8])[0]
+    dataStart = len(MAGIC) + 8 + headerLength
+    header = json.loads(mm[len(MAGIC) + 8:dataStart].decode())
+    return header, dataStart
+
+
+def stagingFileRowCount(filename):
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header, dataStart = _readHeader(mm)
+    return header['rows']
+
+
+def readStagingFile(filename, rowStart = 0, rowEnd = None):
+    """Read rows [rowStart, rowEnd) from a staging file.  Returns a list of OrderedDicts with
+       the same (typed) values that were written."""
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header, dataStart = _readHeader(mm)
+            nrows = header['rows']
+            if rowEnd is None or rowEnd > nrows:
+                rowEnd = nrows
+            if rowStart >= rowEnd:
+                return []
+
+            view = memoryview(mm)
+            columnValues = []
+            try:
+                for column in header['columns']:
+                    nullsStart = dataStart + column['nulls']
+                    nulls = bytes(view[nullsStart + rowStart:nullsStart + rowEnd])
+                    kind = column['kind']
+
+                    if kind in FIXEDWIDTH:
+                        start, length = column['blocks'][0]
+                        values = view[dataStart + start:dataStart + start + length].cast(FIXEDWIDTH[kind])[rowStart:rowEnd].tolist()
+                        if kind == 'bool':
+                            values = [bool(v) for v in values]
+                    else:
+                        start, length = column['blocks'][0]
+                        offsets = view[dataStart + start:dataStart + start + length].cast('q')[rowStart:rowEnd + 1].tolist()
+                        blobStart = dataStart + column['blocks'][1][0]
+                        blob = bytes(view[blobStart + offsets[0]:blobStart + offsets[-1]])
+                        values = [blob[offsets[i] - offsets[0]:offsets[i + 1] - offsets[0]].decode() for i in range(len(offsets) - 1)]
+                        if kind == 'bigint':
+                            values = [int(v) if v else None for v in values]
+
+                    columnValues.append([None if nulls[i] else values[i] for i in range(len(values))])
+            finally:
+                view.release()
+
+    names = [column['name'] for column in header['columns']]
+    return [OrderedDict(zip(names, row)) for row in zip(*columnValues)]
+
+
+def touchStagingFile(filename):
+    """Mark a cache file as recently used."""
+    os.utime(filename, None)
+
+
+def _pidIsAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. no permission - it exists.
+        pass
+    return True
+
+
+def _isStale(name, stat, now):
+    """Leftover temporary files and in-use links (from a process on this host that has gone) are
+       stale once they are older than STALE_SECONDS. The cache directory may be shared between
+       hosts, so we can't rely on the pid alone."""
+    if now - stat.st_mtime < STALE_SECONDS:
+        return False
+    if name.endswith(TEMP_SUFFIX):
+        return True
+    try:
+        pid = int(name[:-len(INUSE_SUFFIX)].rsplit('.', 1)[1])
+    except (IndexError, ValueError):
+        return True
+    return not _pidIsAlive(pid)
+
+
+def evictStagingCache(cacheDir, maxBytes):
+    """Remove stale leftovers, then the least recently used cache files until the cache fits in
+       maxBytes. Every file in the cache counts towards the size, but hard links to the same file
+       only count once."""
+    now = time.time()
+    cacheFiles = []
+    inodes = {}
+    for name in os.listdir(cacheDir):
+        if not (name.endswith(SUFFIX) or name.endswith(INUSE_SUFFIX) or name.endswith(TEMP_SUFFIX)):
+            continue
+        path = os.path.join(cacheDir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Another process got there first.
+            continue
+
+        if not name.endswith(SUFFIX) and _isStale(name, stat, now):
+            try:
+                os.remove(path)
+                print("Removed stale %s from staging cache" % path)
+                continue
+            except OSError:
+                pass
+
+        inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+        if name.endswith(SUFFIX):
+            cacheFiles.append((stat.st_mtime, stat.st_size, stat.st_nlink, path))
+
+    totalBytes = sum(inodes.values())
+    for mtime, size, nlinks, path in sorted(cacheFiles):
+        if totalBytes <= maxBytes:
+            break
+        try:
+            os.remove(path)
+            print("Evicted %s from staging cache" % path)
+        except OSError:
+            continue
+        # If a reader still holds a link, the space isn't freed until it is done.
+        if nlinks == 1:
+            totalBytes -= size
+
+    return totalBytes
@@ -2,7 +2,7 @@
 """Ingest Generic Database tables using multi-value insert statements and multiprocessing.
 
 Usage:
-  %s <configFile> <inputFile>... [--table=<table>] [--bundlesize=<bundlesize>] [--nprocesses=<nprocesses>] [--loglocationInsert=<loglocationInsert>] [--logprefixInsert=<logprefixInsert>] [--loglocationIngest=<loglocationIngest>] [--logprefixIngest=<logprefixIngest>]
+  %s <configFile> <inputFile>... [--table=<table>] [--bundlesize=<bundlesize>] [--transactionsize=<transactionsize>] [--nprocesses=<nprocesses>] [--loglocationInsert=<loglocationInsert>] [--logprefixInsert=<logprefixInsert>] [--loglocationIngest=<loglocationIngest>] [--logprefixIngest=<logprefixIngest>]
   %s (-h | --help)
   %s --version
 
@@ -10,8 +10,9 @@ Options:
   -h --help                                Show this screen.
   --version                                Show version.
   --table=<table>                          Target table name.
-  --bundlesize=<bundlesize>                Group inserts into bundles of specified size [default: 100]
-  --nprocesses=<nprocesses>                Number of processes to use - warning - beware of opening too many processes [default: 8]
+  --bundlesize=<bundlesize>                Group inserts into bundles of specified size. Use auto to adjust the size to the measured insert rate [default: 100]
+  --transactionsize=<transactionsize>      Commit after (at least) this many rows [default: 10000]
+  --nprocesses=<nprocesses>                Number of processes to use - warning - beware of opening too many processes. Each insert process keeps one connection open for all its files. If 1, insert directly [default: 8]
   --loglocationInsert=<loglocationInsert>  Log file location [default: /tmp/]
   --logprefixInsert=<logprefixInsert>      Log prefix [default: inserter]
   --loglocationIngest=<loglocationIngest>  Log file location [default: /tmp/]
@@ -31,6 +32,13 @@ from datetime import timedelta
 import subprocess
 import MySQLdb
 import gzip
+import time
+import multiprocessing
+import multiprocessing.util
+
+# Limits for --bundlesize=auto
+MIN_BUNDLESIZE = 10
+MAX_BUNDLESIZE = 10000
 
 
 def nullValue(value):
@@ -70,68 +78,184 @@ def calculate_htm_ids_bulk(generateHtmidBulk, htmLevel, tempRaDecFile):
     return htmIDs
 
 
+def retryBundles(conn, sql, bundles):
+    """After an error, the open transaction has been (or must be) rolled back. Reconnect if
+       necessary and insert the uncommitted bundles again, committing each one separately so
+       that only the bundles that really fail are lost. Returns the number of rows inserted."""
+    try:
+        conn.rollback()
+    except MySQLdb.Error:
+        pass
+
+    rowsUpdated = 0
+    rowsLost = 0
+    for values in bundles:
+        try:
+            conn.ping(True)
+            cursor = conn.cursor()
+            cursor.executemany(sql, values)
+            rowsUpdated += cursor.rowcount
+            conn.commit()
+            cursor.close()
+        except MySQLdb.Error as e:
+            print("Error %d: %s" % (e.args[0], e.args[1]))
+            try:
+                conn.rollback()
+            except MySQLdb.Error:
+                pass
+            rowsLost += len(values)
+
+    if rowsLost > 0:
+        print("ERROR: %d rows NOT inserted" % rowsLost)
+
+    return rowsUpdated
+
+
 # Use INSERT statements so we can use multiprocessing
-def executeLoad(conn, table, data, bundlesize = 100):
+# The statement is built once and sent with executemany, which MySQLdb rewrites
+# into multi-row inserts. We use one cursor for the whole load and only commit
+# every transactionsize rows. If anything goes wrong, the whole open transaction
+# is rolled back (e.g. by a deadlock), so we retry all the uncommitted bundles.
+# If bundlesize is 'auto' the bundle size is doubled while the insert rate
+# improves and halved when it drops. Pass the same bundleState dict on every call
+# over a connection so the size carries on converging across files and chunks.
+def executeLoad(conn, table, data, bundlesize = 100, transactionsize = 10000, bundleState = None):
 
     rowsUpdated = 0
 
     if len(data) == 0:
         return rowsUpdated
 
+    # The connection may have sat idle for a long time (e.g. while the next file was being
+    # parsed), so reconnect if the server has dropped it.
+    try:
+        conn.ping(True)
+    except MySQLdb.Error as e:
+        print("Error %d: %s" % (e.args[0], e.args[1]))
+        print("ERROR: %d rows NOT inserted" % len(data))
+        return rowsUpdated
+
     keys = list(data[0].keys())
     formatSpecifier = ','.join(['%s' for i in keys])
 
-    chunks = int(1.0 * len(data) / bundlesize + 0.5)
-    if chunks == 0:
-        subList = [data]
-    else:
-        bins, subList = splitList(data, bins = chunks, preserveOrder = True)
-
-
-    for dataChunk in subList:
+    sql = "insert ignore into %s " % table
+    sql += "(%s)" % ','.join(['`%s`' % k for k in keys])
+    sql += " values "
+    sql += "(" + formatSpecifier + ")"
+
+    adaptive = False
+    if bundlesize == 'auto':
+        adaptive = True
+        if bundleState is None:
+            bundleState = {}
+        bundlesize = bundleState.setdefault('bundlesize', 100)
+        lastRate = bundleState.setdefault('lastRate', None)
+    bundlesize = max(1, int(bundlesize))
+
+    cursor = conn.cursor()
+    # The bundles (and rows) inserted since the last commit. They are only counted once committed.
+    uncommitted = []
+    uncommittedRows = 0
+    rowsSinceCommit = 0
+    i = 0
+
+    while i < len(data):
+        dataChunk = data[i:i + bundlesize]
+        i += len(dataChunk)
+
+        values = []
+        for row in dataChunk:
+            values.append(tuple([nullValueNULL(boolToInteger(row[key])) for key in keys]))
+        uncommitted.append(values)
+        rowsSinceCommit += len(dataChunk)
+
+        startTime = time.time()
+        elapsed = None
         try:
-            cursor = conn.cursor(MySQLdb.cursors.DictCursor)
-
-            sql = "insert ignore into %s " % table
-            sql += "(%s)" % ','.join(['`%s`' % k for k in keys])
-            sql += " values "
-            sql += ',\n'.join(['('+formatSpecifier+')' for x in range(len(dataChunk))])
-            sql += ';'
-
-            values = []
-            for row in dataChunk:
-                for key in keys:
-                    values.append(nullValueNULL(boolToInteger(row[key])))
+            cursor.executemany(sql, values)
+            uncommittedRows += cursor.rowcount
 
-            cursor.execute(sql, tuple(values))
+            # Stop the clock before any commit, otherwise the bundles that happen to trigger
+            # a commit look slow and we shrink the bundle size for the wrong reason.
+            elapsed = time.time() - startTime
 
-            rowsUpdated = cursor.rowcount
-            cursor.close ()
+            if rowsSinceCommit >= int(transactionsize):
+                conn.commit()
+                rowsUpdated += uncommittedRows
+                uncommitted = []
+                uncommittedRows = 0
+                rowsSinceCommit = 0
 
         except MySQLdb.Error as e:
             print(cursor._last_executed)
             print("Error %d: %s" % (e.args[0], e.args[1]))
+            rowsUpdated += retryBundles(conn, sql, uncommitted)
+            uncommitted = []
+            uncommittedRows = 0
+            rowsSinceCommit = 0
+            cursor = conn.cursor()
+
+        # Don't adapt on the last (short) bundle - its fixed overhead makes the rate look worse.
+        if adaptive and elapsed and len(dataChunk) == bundlesize:
+            rate = len(dataChunk) / elapsed
+            if lastRate is None or rate >= lastRate:
+                bundlesize = min(bundlesize * 2, MAX_BUNDLESIZE)
+            elif rate < 0.9 * lastRate:
+                bundlesize = max(bundlesize // 2, MIN_BUNDLESIZE)
+            lastRate = rate
+
+    if uncommitted:
+        try:
+            conn.commit()
+            rowsUpdated += uncommittedRows
+        except MySQLdb.Error as e:
+            print("Error %d: %s" % (e.args[0], e.args[1]))
+            rowsUpdated += retryBundles(conn, sql, uncommitted)
+
+    try:
+        cursor.close()
+    except MySQLdb.Error:
+        pass
 
-        conn.commit()
+    if adaptive:
+        bundleState['bundlesize'] = bundlesize
+        bundleState['lastRate'] = lastRate
+        print("Bundle size = %d" % bundlesize)
 
     return rowsUpdated
 
 
-def workerInsert(num, db, objectListFragment, dateAndTime, firstPass, miscParameters):
-    """thread worker function"""
+# Each insert process keeps its connection (and adaptive bundle size) for all
+# the chunks and files it is given.
+insertWorkerState = {}
+
+def initInsertWorker(db, options, dateAndTime):
+    """Pool initializer - open one connection per insert process"""
     # Redefine the output to be a log file.
-    options = miscParameters[0]
-    sys.stdout = open('%s%s_%s_%d.log' % (options.loglocationInsert, options.logprefixInsert, dateAndTime, num), "w")
-    conn = dbConnect(db['hostname'], db['username'], db['password'], db['database'], quitOnError = True)
+    sys.stdout = open('%s%s_%s_%d.log' % (options.loglocationInsert, options.logprefixInsert, dateAndTime, os.getpid()), "w")
+    insertWorkerState['options'] = options
+    insertWorkerState['bundleState'] = {}
 
-    # This is in the worker function
-    objectsForUpdate = executeLoad(conn, options.table, objectListFragment, int(options.bundlesize))
+    # Don't exit here if we can't connect - the pool would just keep starting new workers.
+    # workerInsert raises instead, which pool.map passes back to the parent.
+    conn = dbConnect(db['hostname'], db['username'], db['password'], db['database'], quitOnError = False)
+    insertWorkerState['conn'] = conn
 
-    print("Process complete.")
-    conn.close()
-    print("DB Connection Closed - exiting")
+    if conn is not None:
+        # Close the connection when the pool shuts the process down.
+        multiprocessing.util.Finalize(None, conn.close, exitpriority = 10)
 
-    return 0
+
+def workerInsert(objectListFragment):
+    """pool worker function"""
+    if insertWorkerState['conn'] is None:
+        raise RuntimeError("Insert process %d could not connect to the database" % os.getpid())
+
+    options = insertWorkerState['options']
+    rowsUpdated = executeLoad(insertWorkerState['conn'], options.table, objectListFragment, options.bundlesize, int(options.transactionsize), bundleState = insertWorkerState['bundleState'])
+    sys.stdout.flush()
+
+    return rowsUpdated
 
 def ingestData(options, inputFiles):
     generateHtmidBulk = which('generate_htmid_bulk')
@@ -157,6 +281,22 @@ def ingestData(options, inputFiles):
     (year, month, day, hour, min, sec) = currentDate.split(':')
     dateAndTime = "%s%s%s_%s%s%s" % (year, month, day, hour, min, sec)
 
+    nprocesses = int(options.nprocesses)
+
+    # Open the connection(s) once for all the files. With one process we insert directly,
+    # otherwise we hand the chunks to a pool of insert processes, each with its own connection.
+    conn = None
+    pool = None
+    bundleState = {}
+    if nprocesses == 1:
+        conn = dbConnect(db['hostname'], db['username'], db['password'], db['database'], quitOnError = True)
+    else:
+        # Check the credentials once here, so a bad password or a down server stops us straight away.
+        conn = dbConnect(db['hostname'], db['username'], db['password'], db['database'], quitOnError = True)
+        conn.close()
+        conn = None
+        pool = multiprocessing.Pool(nprocesses, initializer = initInsertWorker, initargs = (db, options, dateAndTime))
+
     for inputFile in inputFiles:
         print("Ingesting %s" % inputFile)
         if 'gz' in inputFile:
@@ -190,14 +330,23 @@ def ingestData(options, inputFiles):
     
     
     
-        nprocesses = int(options.nprocesses)
-    
-        if len(data) > 0:
+        if conn is not None:
+            rowsUpdated = executeLoad(conn, options.table, data, options.bundlesize, int(options.transactionsize), bundleState = bundleState)
+            print("%s Rows inserted = %d" % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S"), rowsUpdated))
+
+        elif len(data) > 0:
             nProcessors, listChunks = splitList(data, bins = nprocesses, preserveOrder=True)
     
             print("%s Parallel Processing..." % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
-            parallelProcess(db, dateAndTime, nProcessors, listChunks, workerInsert, miscParameters = [options], drainQueues = False)
-            print("%s Done Parallel Processing" % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S")))
+            rowsUpdated = sum(pool.map(workerInsert, listChunks))
+            print("%s Done Parallel Processing. Rows inserted = %d" % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S"), rowsUpdated))
+
+    if conn is not None:
+        conn.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
     
@@ -0,0 +1,36 @@
+import os
+import pytest
+
+pytest.importorskip('docopt')
+pytest.importorskip('gkhtm')
+pytest.importorskip('cassandra')
+commonutils = pytest.importorskip('gkutils.commonutils')
+
+from gkdbutils.ingesters.cassandra.ingestGenericDatabaseTable import readGenericDataFileRange, splitFileByteRanges
+
+
+@pytest.fixture
+def dophotFile(tmp_path):
+    filename = str(tmp_path / 'test.dph')
+    with open(filename, 'w') as f:
+        f.write('#   RA  Dec  m\n')
+        for i in range(50):
+            f.write('  %d.0  %d.5  %d\n' % (i, i, i))
+    return filename
+
+
+def test_whole_file_matches_readGenericDataFile(dophotFile):
+    expected = commonutils.readGenericDataFile(dophotFile, delimiter=' ', useOrderedDict=True)
+    rows = readGenericDataFileRange(dophotFile, 0, os.path.getsize(dophotFile), delimiter=' ')
+
+    assert [dict(row) for row in rows] == [dict(row) for row in expected]
+    assert dict(rows[1]) == {'RA': '1.0', 'Dec': '1.5', 'm': '1'}
+
+
+@pytest.mark.parametrize('nranges', [1, 2, 3, 7, 50, 100])
+def test_byte_ranges_cover_every_row_once(dophotFile, nranges):
+    rows = []
+    for inputFile, byteStart, byteEnd in splitFileByteRanges(dophotFile, nranges):
+        rows += readGenericDataFileRange(inputFile, byteStart, byteEnd, delimiter=' ')
+
+    assert [row['m'] for row in rows] == [str(i) for i in range(50)]
@@ -0,0 +1,84 @@
+import os
+import time
+import importlib.util
+
+import pytest
+
+# Load the module directly - importing the gkdbutils package pulls in the database drivers.
+_spec = importlib.util.spec_from_file_location('ledger', os.path.join(os.path.dirname(__file__), '..', 'gkdbutils', 'ingesters', 'cassandra', 'ledger.py'))
+ledger = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(ledger)
+
+
+@pytest.fixture
+def ledgerFile(tmp_path):
+    return str(tmp_path / 'ledger.sqlite')
+
+
+def test_add_files_is_idempotent(ledgerFile):
+    hostA = ledger.SQLiteLedger(ledgerFile)
+    hostA.addFiles(['a', 'b'])
+    assert hostA.claim('hostA') == 'a'
+    assert hostA.setStatus('a', 'hostA', ledger.DONE)
+
+    # A second host adding an overlapping list doesn't reset or duplicate anything.
+    hostB = ledger.SQLiteLedger(ledgerFile)
+    hostB.addFiles(['a', 'b', 'c'])
+
+    assert hostB.pending() == 2
+    assert sorted(hostB.conn.execute('select filename, status from ingest_ledger').fetchall()) == [('a', 'done'), ('b', 'pending'), ('c', 'pending')]
+
+
+def test_claims_are_exclusive(ledgerFile):
+    hostA = ledger.SQLiteLedger(ledgerFile)
+    hostB = ledger.SQLiteLedger(ledgerFile)
+    hostA.addFiles(['a', 'b', 'c'])
+
+    claimed = [hostA.claim('hostA'), hostB.claim('hostB'), hostA.claim('hostA')]
+    assert sorted(claimed) == ['a', 'b', 'c']
+    assert hostB.claim('hostB') is None
+
+    # Leased files are still pending until they are done.
+    assert hostB.pending() == 3
+
+
+def test_expired_lease_is_reclaimed(ledgerFile):
+    deadHost = ledger.SQLiteLedger(ledgerFile, leaseSeconds = 0.2)
+    liveHost = ledger.SQLiteLedger(ledgerFile, leaseSeconds = 0.2)
+    deadHost.addFiles(['a'])
+
+    assert deadHost.claim('deadHost') == 'a'
+    assert liveHost.claim('liveHost') is None
+
+    time.sleep(0.3)
+    assert liveHost.claim('liveHost') == 'a'
+
+
+def test_renew_keeps_the_lease(ledgerFile):
+    hostA = ledger.SQLiteLedger(ledgerFile, leaseSeconds = 0.3)
+    hostB = ledger.SQLiteLedger(ledgerFile, leaseSeconds = 0.3)
+    hostA.addFiles(['a'])
+    assert hostA.claim('hostA') == 'a'
+
+    for i in range(3):
+        time.sleep(0.15)
+        assert hostA.renew('a', 'hostA')
+        assert hostB.claim('hostB') is None
+
+
+def test_lost_lease(ledgerFile):
+    hostA = ledger.SQLiteLedger(ledgerFile, leaseSeconds = 0.2)
+    hostB = ledger.SQLiteLedger(ledgerFile, leaseSeconds = 0.2)
+    hostA.addFiles(['a'])
+    assert hostA.claim('hostA') == 'a'
+
+    time.sleep(0.3)
+    assert hostB.claim('hostB') == 'a'
+
+    # hostA can neither renew nor finish a file it has lost.
+    assert not hostA.renew('a', 'hostA')
+    assert not hostA.setStatus('a', 'hostA', ledger.DONE)
+    assert hostB.setStatus('a', 'hostB', ledger.FAILED)
+
+    assert hostA.pending() == 0
+    assert hostA.claim('hostA') is None
@@ -0,0 +1,118 @@
+import multiprocessing
+
+import pytest
+
+pytest.importorskip('docopt')
+pytest.importorskip('gkutils')
+MySQLdb = pytest.importorskip('MySQLdb')
+
+from gkdbutils.ingesters.mysql import ingestGenericDatabaseTable as ingester
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+        self._last_executed = None
+
+    def executemany(self, sql, values):
+        self._last_executed = sql
+        if self.conn.failures:
+            self.conn.failures.pop(0)
+            raise MySQLdb.OperationalError(1213, 'Deadlock found when trying to get lock')
+        self.conn.uncommitted += values
+        self.rowcount = len(values)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, failures = None):
+        self.failures = failures or []
+        self.uncommitted = []
+        self.committed = []
+        self.commits = 0
+        self.pings = 0
+
+    def ping(self, reconnect = False):
+        self.pings += 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed += self.uncommitted
+        self.uncommitted = []
+        self.commits += 1
+
+    def rollback(self):
+        self.uncommitted = []
+
+    def close(self):
+        pass
+
+
+def makeData(nrows):
+    return [{'id': str(i), 'flag': 'true' if i % 2 else ''} for i in range(nrows)]
+
+
+def test_commits_every_transactionsize_rows():
+    conn = FakeConnection()
+    rowsUpdated = ingester.executeLoad(conn, 'test', makeData(2500), bundlesize = 100, transactionsize = 1000)
+
+    assert rowsUpdated == 2500
+    assert conn.commits == 3
+    assert conn.pings == 1
+    assert conn.committed[:2] == [('0', None), ('1', '1')]
+
+
+def test_rolled_back_transaction_is_retried():
+    # The first bundle of the second transaction deadlocks, which rolls back the whole transaction.
+    conn = FakeConnection()
+    data = makeData(300)
+    ingester.executeLoad(conn, 'test', data[:100], bundlesize = 50, transactionsize = 100)
+    conn.failures = [True]
+    rowsUpdated = ingester.executeLoad(conn, 'test', data[100:], bundlesize = 50, transactionsize = 100)
+
+    assert rowsUpdated == 200
+    assert sorted(int(row[0]) for row in conn.committed) == list(range(300))
+
+
+def test_rows_that_cannot_be_inserted_are_not_counted():
+    # Fails first time and again on the retry.
+    conn = FakeConnection(failures = [True, True])
+    rowsUpdated = ingester.executeLoad(conn, 'test', makeData(200), bundlesize = 100, transactionsize = 1000)
+
+    assert rowsUpdated == 100
+    assert len(conn.committed) == 100
+
+
+def test_adaptive_bundle_size_is_kept_between_calls():
+    conn = FakeConnection()
+    bundleState = {}
+    ingester.executeLoad(conn, 'test', makeData(1000), bundlesize = 'auto', bundleState = bundleState)
+    firstSize = bundleState['bundlesize']
+    ingester.executeLoad(conn, 'test', makeData(5), bundlesize = 'auto', bundleState = bundleState)
+
+    assert bundleState['lastRate'] is not None
+    # A short final bundle doesn't change the size.
+    assert bundleState['bundlesize'] == firstSize
+    assert len(conn.committed) == 1005
+
+
+def test_pool_fails_instead_of_respawning_when_it_cannot_connect(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingester, 'dbConnect', lambda *args, **kwargs: None)
+    options = type('Options', (object,), {'loglocationInsert': str(tmp_path) + '/', 'logprefixInsert': 'inserter',
+                                          'table': 'test', 'bundlesize': '100', 'transactionsize': '1000'})
+    db = {'hostname': 'localhost', 'username': 'user', 'password': 'wrong', 'database': 'test'}
+
+    pool = multiprocessing.Pool(2, initializer = ingester.initInsertWorker, initargs = (db, options, 'now'))
+    try:
+        with pytest.raises(RuntimeError):
+            pool.map_async(ingester.workerInsert, [makeData(10)]).get(timeout = 30)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    assert len(list(tmp_path.iterdir())) <= 2
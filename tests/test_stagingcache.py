@@ -0,0 +1,111 @@
+import os
+import time
+import importlib.util
+from collections import OrderedDict
+
+import pytest
+
+# Load the module directly - importing the gkdbutils package pulls in the database drivers.
+_spec = importlib.util.spec_from_file_location('stagingcache', os.path.join(os.path.dirname(__file__), '..', 'gkdbutils', 'ingesters', 'cassandra', 'stagingcache.py'))
+stagingcache = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(stagingcache)
+
+
+@pytest.fixture
+def rows():
+    return [OrderedDict([('ra', 1.5 * i),
+                         ('n', i if i % 3 else None),
+                         ('name', 'héllo%d' % i if i % 2 else None),
+                         ('flag', bool(i % 2)),
+                         ('big', 2 ** 70 + i if i != 4 else None),
+                         ('empty', None)]) for i in range(10)]
+
+
+def test_round_trip(tmp_path, rows):
+    filename = stagingcache.stagingCachePath(str(tmp_path), 'key')
+    stagingcache.writeStagingFile(filename, rows)
+
+    assert stagingcache.stagingFileRowCount(filename) == 10
+    assert stagingcache.readStagingFile(filename) == rows
+
+
+def test_row_slices(tmp_path, rows):
+    filename = stagingcache.stagingCachePath(str(tmp_path), 'key')
+    stagingcache.writeStagingFile(filename, rows)
+
+    assert stagingcache.readStagingFile(filename, 3, 7) == rows[3:7]
+    assert stagingcache.readStagingFile(filename, 9, 100) == rows[9:]
+    assert stagingcache.readStagingFile(filename, 5, 5) == []
+
+
+def test_types_are_kept(tmp_path, rows):
+    filename = stagingcache.stagingCachePath(str(tmp_path), 'key')
+    stagingcache.writeStagingFile(filename, rows)
+    row = stagingcache.readStagingFile(filename, 1, 2)[0]
+
+    assert type(row['ra']) is float
+    assert type(row['n']) is int
+    assert type(row['flag']) is bool
+    assert row['big'] == 2 ** 70 + 1
+
+
+def test_empty_file(tmp_path):
+    filename = stagingcache.stagingCachePath(str(tmp_path), 'key')
+    stagingcache.writeStagingFile(filename, [])
+
+    assert stagingcache.stagingFileRowCount(filename) == 0
+    assert stagingcache.readStagingFile(filename) == []
+
+
+def test_ints_mixed_with_floats_become_floats(tmp_path):
+    filename = stagingcache.stagingCachePath(str(tmp_path), 'key')
+    stagingcache.writeStagingFile(filename, [{'x': 1}, {'x': 2.5}])
+
+    values = [row['x'] for row in stagingcache.readStagingFile(filename)]
+    assert values == [1.0, 2.5]
+    assert all(type(v) is float for v in values)
+
+
+@pytest.mark.parametrize('values', [[1, 'a'], [True, 1], [b'\x00ab']])
+def test_unsupported_columns_are_not_cached(tmp_path, values):
+    filename = stagingcache.stagingCachePath(str(tmp_path), 'key')
+    with pytest.raises(ValueError):
+        stagingcache.writeStagingFile(filename, [{'x': v} for v in values])
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_lru_eviction_order(tmp_path):
+    cacheDir = str(tmp_path)
+    data = [{'x': float(i)} for i in range(100)]
+    now = time.time()
+    for i, key in enumerate(['oldest', 'middle', 'newest']):
+        filename = stagingcache.stagingCachePath(cacheDir, key)
+        stagingcache.writeStagingFile(filename, data)
+        os.utime(filename, (now - 100 + i, now - 100 + i))
+    fileSize = os.path.getsize(stagingcache.stagingCachePath(cacheDir, 'oldest'))
+
+    # A hit makes the oldest file the most recently used.
+    stagingcache.touchStagingFile(stagingcache.stagingCachePath(cacheDir, 'oldest'))
+    totalBytes = stagingcache.evictStagingCache(cacheDir, 2 * fileSize)
+
+    assert sorted(os.listdir(cacheDir)) == ['newest.gksc', 'oldest.gksc']
+    assert totalBytes == 2 * fileSize
+
+
+def test_stale_leftovers_are_removed(tmp_path):
+    cacheDir = str(tmp_path)
+    stale = time.time() - stagingcache.STALE_SECONDS - 10
+
+    tempFile = os.path.join(cacheDir, 'abc' + stagingcache.TEMP_SUFFIX)
+    deadLink = os.path.join(cacheDir, 'key.gksc.999999999' + stagingcache.INUSE_SUFFIX)
+    liveLink = os.path.join(cacheDir, 'key.gksc.%d%s' % (os.getpid(), stagingcache.INUSE_SUFFIX))
+    for filename in (tempFile, deadLink, liveLink):
+        with open(filename, 'wb') as f:
+            f.write(b'x' * 100)
+        os.utime(filename, (stale, stale))
+
+    totalBytes = stagingcache.evictStagingCache(cacheDir, 10 ** 6)
+
+    assert os.listdir(cacheDir) == [os.path.basename(liveLink)]
+    assert totalBytes == 100